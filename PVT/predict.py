@@ -20,7 +20,7 @@ assert y_test.shape == (10000, 1)
 
 
 ds_test = tf.data.Dataset.from_tensor_slices((x_test, y_test))
-ds_test = ds_test.cache().batch(batch_size, drop_remainder=True).map(preprocess)
+ds_test = ds_test.map(preprocess, num_parallel_calls=tf.data.AUTOTUNE).batch(batch_size, drop_remainder=True)
 
 test_data, test_label = next(iter(ds_test))
 
@@ -1,7 +1,7 @@
 import os
 import tensorflow as tf
-import tensorflow_addons as tfa
 from tensorflow.keras import layers, Model
+from common.initializers import DenseGlorotUniform
 
 os.environ['CPP_TF_MIN_LOG_LEVEL'] = '2'
 
@@ -13,16 +13,16 @@ class MLP(layers.Layer):
     def __init__(self, name, hidden_features, out_features, drop_rate=0):
         super(MLP, self).__init__()
         self.fc1 = layers.Dense(hidden_features, name=f'{name}_MLP_DENSE1')
-        self.act = tfa.layers.GELU()
+        self.act = layers.Lambda(lambda x: tf.nn.gelu(x, approximate=True))
         self.fc2 = layers.Dense(out_features, name=f'{name}_MLP_DENSE2')
-        self.drop = layers.Dropout(drop_rate, name=f'{name}_MLP_DROP')
+        self.drop = layers.Dropout(drop_rate, name=f'{name}_MLP_DROP') if drop_rate > 0 else None
 
 
     def call(self, inputs, training=None):
         x = self.fc1(inputs)
         x = self.act(x)
         x = self.fc2(x)
-        if training:
+        if self.drop is not None:
             x = self.drop(x)
         return x
 
@@ -38,64 +38,69 @@ class Attention(layers.Layer):
         self.head_dim = dim // num_heads # dimension for each head
         self.scale = qk_scale or self.head_dim ** -.5
 
-        self.q = layers.Dense(dim, use_bias=qkv_bias, name=f'{name}_Q')
-        self.kv = layers.Dense(2 * dim, use_bias=qkv_bias, name=f'{name}_KV')
-        self.attention_drop = layers.Dropout(attn_drop, name=f'{name}_ATTEN_DROP')
-        self.proj = layers.Dense(dim, name=f'{name}_PROJ_DENSE')
-        self.proj_drop = layers.Dropout(proj_drop, name=f'{name}_PROJ_DROP')
-
+        # sr_ratio is either one ratio for both axes or a (height, width) pair once tokens have been merged
         self.sr_ratio = sr_ratio
-        if sr_ratio > 1:
-            self.sr = layers.Conv2D(dim, kernel_size=sr_ratio, strides=sr_ratio, name=f'{name}_SR_CONV2D')
+        self.sr_h, self.sr_w = (sr_ratio, sr_ratio) if isinstance(sr_ratio, int) else sr_ratio
+        self.reduce_kv = self.sr_h * self.sr_w > 1
+        # projections write straight into the head layout, no reshape or transpose needed afterwards
+        if self.reduce_kv:
+            # (b, N, C) -> (b, num_heads, N, head_dim)
+            self.q = layers.EinsumDense('bnc,chd->bhnd', output_shape=(num_heads, None, self.head_dim),
+                                        bias_axes='hd' if qkv_bias else None, kernel_initializer=DenseGlorotUniform(), name=f'{name}_Q')
+            # (b, N', C) -> (b, 2, num_heads, N', head_dim)
+            self.kv = layers.EinsumDense('bnc,cihd->bihnd', output_shape=(2, num_heads, None, self.head_dim),
+                                         bias_axes='ihd' if qkv_bias else None, kernel_initializer=DenseGlorotUniform(), name=f'{name}_KV')
+            # non-overlapping sr_h x sr_w conv, expressed as one GEMM over each sr_h x sr_w block of tokens
+            # (b, H/sr_h, sr_h, W/sr_w, sr_w, C) -> (b, H/sr_h, W/sr_w, C)
+            self.sr = layers.EinsumDense('bhpwqc,pqcd->bhwd', output_shape=(None, None, dim), bias_axes='d', name=f'{name}_SR')
             self.norm = layers.LayerNormalization()
+        else:
+            # q and kv read the same input, so project them with a single GEMM
+            # (b, N, C) -> (b, 3, num_heads, N, head_dim)
+            self.qkv = layers.EinsumDense('bnc,cihd->bihnd', output_shape=(3, num_heads, None, self.head_dim),
+                                          bias_axes='ihd' if qkv_bias else None, name=f'{name}_QKV',
+                                          # q slice scaled like the old Dense(dim), k and v slices like the old Dense(2 * dim)
+                                          kernel_initializer=DenseGlorotUniform(fan_outs=[dim, 2 * dim, 2 * dim]))
+        self.attention_drop = layers.Dropout(attn_drop, name=f'{name}_ATTEN_DROP') if attn_drop > 0 else None
+        # (b, num_heads, N, head_dim) -> (b, N, C)
+        self.proj = layers.EinsumDense('bhnd,hdc->bnc', output_shape=(None, dim), bias_axes='c',
+                                       kernel_initializer=DenseGlorotUniform(fan_in_dims=2), name=f'{name}_PROJ_DENSE')
+        self.proj_drop = layers.Dropout(proj_drop, name=f'{name}_PROJ_DROP') if proj_drop > 0 else None
 
 
     def call(self, inputs, H, W):
-        # (b, 196, 768) -> (b, 196, num_heads, head_dim)
-        q = layers.Reshape((-1, self.num_heads, self.head_dim))(self.q(inputs))
-        # (b, 196, num_heads, head_dim)-> (b, num_heads, 196, head_dim)
-        q = tf.transpose(q, [0, 2, 1, 3])
-
-        if self.sr_ratio > 1:
-            # (b, 196, 768) -> (b, 14, 14, 768)
-            x_ = tf.reshape(inputs, [-1, H, W, self.dim])
-            # (b, 14, 14, 768) -> (b, 7, 7, 768)
+        if self.reduce_kv:
+            # (b, 196, 768) -> (b, num_heads, 196, head_dim)
+            q = self.q(inputs)
+            # (b, 196, 768) -> (b, 7, 2, 7, 2, 768)
+            x_ = tf.reshape(inputs, [-1, H//self.sr_h, self.sr_h, W//self.sr_w, self.sr_w, self.dim])
+            # (b, 7, 2, 7, 2, 768) -> (b, 7, 7, 768)
             x_ = self.sr(x_)
             # (b, 7, 7, 768) -> (b, 49, 768)
-            x_ = tf.reshape(x_, [-1, H//self.sr_ratio * W//self.sr_ratio, self.dim])
+            x_ = tf.reshape(x_, [-1, (H//self.sr_h) * (W//self.sr_w), self.dim])
             # (b, 49, 768)
             x_ = self.norm(x_)
-            # (b, 49, 768) -> # (b, 49, 768 *2)
+            # (b, 49, 768) -> (b, 2, num_heads, 49, head_dim)
             kv = self.kv(x_)
-            # (b, 49, 768 *2) -> (b, 49, 2, num_heads, head_dim)
-            kv = tf.reshape(kv, [-1, H//self.sr_ratio * W//self.sr_ratio, 2, self.num_heads, self.head_dim])
-            # (b, 49, 2, num_heads, head_dim) -> (2, b, num_heads, 49, head_dim)
-            kv = tf.transpose(kv, [2, 0, 3, 1, 4])
+            k, v = kv[:, 0], kv[:, 1]
         else:
-            # (b, 196, 768) -> # (b, 49, 768 *2)
-            kv = self.kv(inputs)
-            # (b, 196, 768 *2) -> (b, 196, 2, num_heads, head_dim)
-            kv = layers.Reshape((-1, 2, self.num_heads, self.head_dim))(kv)
-            # (b, 49, 2, num_heads, head_dim) -> (2, b, num_heads, 49, head_dim)
-            kv = tf.transpose(kv, [2, 0, 3, 1, 4])
-
-        k, v = kv[0], kv[1]
+            # (b, 196, 768) -> (b, 3, num_heads, 196, head_dim)
+            qkv = self.qkv(inputs)
+            q, k, v = qkv[:, 0], qkv[:, 1], qkv[:, 2]
 
         # calc attention
         # (b, num_heads, 196, 96) * (b, num_heads, 96, 196) ->  (b, num_heads, 196, 196)
-        attention = tf.matmul(q, tf.transpose(k, [0,1,3,2])) * self.scale
+        attention = tf.matmul(q, k, transpose_b=True) * self.scale
         # (b, num_heads, 196, 196)
         attention = tf.nn.softmax(attention, axis=-1)
-        attention = self.attention_drop(attention)
+        if self.attention_drop is not None:
+            attention = self.attention_drop(attention)
         # (b, num_heads, 196, 196) * # (b, num_heads, 196, 96) -> (b, num_heads, 196, 96)
         x = tf.matmul(attention, v)
-        # (b, num_heads, 196, 96) -> (b, 196, num_heads, 96)
-        x = tf.transpose(x, [0, 2, 1, 3])
-        # (b, 196, num_heads, 96) -> (b, 196, num_heads * 96)
-        x = layers.Reshape((-1, self.num_heads * self.head_dim))(x)
-        # (b, N, C) -> (b, N, proj_dim)
+        # (b, num_heads, 196, 96) -> (b, 196, num_heads * 96)
         x = self.proj(x)
-        x = self.proj_drop(x)
+        if self.proj_drop is not None:
+            x = self.proj_drop(x)
 
         return x
 
@@ -120,28 +125,153 @@ class Block(layers.Layer):
         return x + y
 
 
+def merge_tokens(x, H, W, axis):
+    """
+    Merge every pair of neighbouring tokens along one axis of the token grid by averaging them
+    :param x: tokens with shape (b, H*W, C)
+    :param H: grid height
+    :param W: grid width
+    :param axis: 'w' merges horizontal neighbours, 'h' merges vertical neighbours
+    :return: merged tokens (b, H*W/2, C) and the new grid height and width
+    """
+    C = x.shape[-1]
+    if axis == 'w':
+        # (b, H*W, C) -> (b, H, W/2, 2, C) -> (b, H, W/2, C)
+        x = tf.reduce_mean(tf.reshape(x, [-1, H, W // 2, 2, C]), axis=3)
+        W = W // 2
+    else:
+        # (b, H*W, C) -> (b, H/2, 2, W, C) -> (b, H/2, W, C)
+        x = tf.reduce_mean(tf.reshape(x, [-1, H // 2, 2, W, C]), axis=2)
+        H = H // 2
+    return tf.reshape(x, [-1, H * W, C]), H, W
+
+
+def unmerge_tokens(x, H, W, target_H, target_W):
+    """
+    Copy merged tokens back onto the full token grid
+    :param x: merged tokens with shape (b, H*W, C)
+    :return: tokens with shape (b, target_H*target_W, C)
+    """
+    C = x.shape[-1]
+    x = tf.reshape(x, [-1, H, W, C])
+    x = tf.repeat(x, target_H // H, axis=1)
+    x = tf.repeat(x, target_W // W, axis=2)
+    return tf.reshape(x, [-1, target_H * target_W, C])
+
+
+class Stage(layers.Layer):
+    """
+    Transformer encoder of one PVT stage, a stack of depth blocks working on the same (H, W) token grid
+    Each block is registered as its own attribute so Keras tracks it directly
+    If merge_every is set, neighbouring tokens are merged after every merge_every blocks, alternating between
+    width and height, so later blocks attend over half as many tokens. Merging stops once the axis to merge is odd,
+    so the grid always stays whole. The full grid is restored at the end of the stage
+    """
+    def __init__(self, name, depth, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0., proj_drop=0., sr_ratio=1,
+                 grid_size=None, merge_every=None):
+        super(Stage, self).__init__()
+        self.depth = depth
+        self.grid_size = grid_size
+        self.merge_every = merge_every
+        self.merge_axes = self.plan_merges(depth, grid_size, merge_every)
+
+        H, W = grid_size if grid_size is not None else (None, None)
+        sr_h, sr_w = sr_ratio, sr_ratio
+        for i, axis in enumerate(self.merge_axes):
+            if axis == 'w':
+                # the grid lost half its width, halve the reduction on that axis so kv keeps its length
+                W, sr_w = W // 2, max(sr_w // 2, 1)
+            elif axis == 'h':
+                H, sr_h = H // 2, max(sr_h // 2, 1)
+            if H is not None and (H % sr_h != 0 or W % sr_w != 0):
+                raise ValueError(f"{name}: block {i} works on a {H}x{W} token grid which can not be reduced by sr_ratio {sr_h}x{sr_w}.")
+            setattr(self, f'block{i}', Block(f'{name}_{i}', dim, num_heads, mlp_ratio, qkv_bias, qk_scale, drop, attn_drop, proj_drop, (sr_h, sr_w)))
+
+    @staticmethod
+    def plan_merges(depth, grid_size, merge_every):
+        """
+        plan the grid axis merged right before each block
+        :param depth: number of blocks
+        :param grid_size: (H, W) token grid of the stage
+        :param merge_every: merge after every merge_every blocks, None to disable
+        :return: list with 'w', 'h' or None for each block
+        """
+        if merge_every is None:
+            return [None] * depth
+        if not isinstance(merge_every, int) or merge_every < 1:
+            raise ValueError(f"merge_every should be a positive integer or None, but got {merge_every}.")
+        if grid_size is None:
+            raise ValueError("grid_size is needed to plan token merging.")
+
+        H, W = grid_size
+        merge_axes = []
+        next_axis = 'w'
+        for i in range(depth):
+            axis = None
+            if next_axis is not None and i > 0 and i % merge_every == 0:
+                if (W if next_axis == 'w' else H) % 2 == 0:
+                    axis = next_axis
+                    if axis == 'w':
+                        W, next_axis = W // 2, 'h'
+                    else:
+                        H, next_axis = H // 2, 'w'
+                else:
+                    # the axis to merge is odd, stop merging for the rest of the stage
+                    next_axis = None
+            merge_axes.append(axis)
+        return merge_axes
+
+    def call(self, inputs, H, W):
+        x = inputs
+        h, w = H, W
+        for i, axis in enumerate(self.merge_axes):
+            if axis is not None:
+                x, h, w = merge_tokens(x, h, w, axis)
+            x = getattr(self, f'block{i}')(x, h, w)
+        if (h, w) != (H, W):
+            x = unmerge_tokens(x, h, w, H, W)
+        return x
+
+
 class PatchEmbedding(layers.Layer):
 
-    def __init__(self, name, img_size=224, patch_size=16, embedding_dim=768):
+    def __init__(self, name, img_size=224, patch_size=16, embedding_dim=768, use_pos_embed=False):
         super(PatchEmbedding, self).__init__()
         self.img_size = img_size
         self.patch_size = patch_size
         self.embedding_dim = embedding_dim
+        self.use_pos_embed = use_pos_embed
         assert img_size % patch_size == 0, f"img_size {img_size} should be divided by patch_size {patch_size}."
 
         self.H, self.W = img_size // patch_size, img_size // patch_size
         self.num_patches = self.H * self.W
-        self.project = layers.Conv2D(embedding_dim, kernel_size=patch_size, strides=patch_size, name=f'{name}_PATCH_CONV2D')
+        # non-overlapping patch_size x patch_size conv, expressed as space_to_depth followed by a projection
+        # the (p, p, c, d) kernel gets the same glorot fans as the Conv2D kernel it replaces
+        self.project = layers.EinsumDense('bnpqc,pqcd->bnd', output_shape=(None, embedding_dim), bias_axes='d', name=f'{name}_PATCH_DENSE')
         self.norm = layers.LayerNormalization()
+        # position embedding added to the patches right here, so no separate add site is needed in the model
+        self.pos_embed = None
+
+
+    def build(self, input_shape):
+        if self.use_pos_embed:
+            self.pos_embed = self.add_weight(shape=[1, self.num_patches, self.embedding_dim],
+                                             initializer=tf.keras.initializers.TruncatedNormal(mean=0., stddev=.02), name='pos_embed')
+        super(PatchEmbedding, self).build(input_shape)
 
 
     def call(self, inputs):
-        # (b, 224, 224, 3) -> (b, 14, 14, 768)
-        x = self.project(inputs)
-        #  (b, 14, 14, 768) -> (b, 196, 768)
-        x = tf.reshape(x, [-1, self.num_patches, self.embedding_dim])
+        # (b, 224, 224, 3) -> (b, 14, 14, 16 * 16 * 3)
+        x = tf.nn.space_to_depth(inputs, self.patch_size)
+        # (b, 14, 14, 16 * 16 * 3) -> (b, 196, 16, 16, 3)
+        x = tf.reshape(x, [-1, self.num_patches, self.patch_size, self.patch_size, inputs.shape[-1]])
+        # (b, 196, 16, 16, 3) -> (b, 196, 768)
+        x = self.project(x)
         # (b, 196, 768)
         x = self.norm(x)
+        if self.use_pos_embed:
+            # adding position embedding
+            x = x + tf.cast(self.pos_embed, dtype=x.dtype)
         return x, (self.H, self.W)
 
 
@@ -161,7 +291,8 @@ class PyramidVisionTransformer(Model):
                  drop_rate=0.,
                  attn_drop_rate=0.,
                  depths=[3, 4, 6, 3],
-                 sr_ratios=[8, 4, 2, 1]):
+                 sr_ratios=[8, 4, 2, 1],
+                 merge_every=None):
         """
         initialize function for PVC
         :param img_size: image size default value 224
@@ -176,6 +307,7 @@ class PyramidVisionTransformer(Model):
         :param attn_drop_rate: attention drop rate
         :param depths: number of attention modules from stage 1 to 4
         :param sr_ratios: spatial reduction attention ratios from stage 1 to 4
+        :param merge_every: merge neighbouring tokens after every merge_every blocks in stage 1 to 3, None to disable
         """
         super(PyramidVisionTransformer, self).__init__()
 
@@ -184,43 +316,44 @@ class PyramidVisionTransformer(Model):
         self.batch_size = batch_size
         self.embed_dims = embed_dims
 
-        # patch_embed
-        self.patch_embed1 = PatchEmbedding(name='patch_embed1', img_size=img_size, patch_size=patch_size, embedding_dim=embed_dims[0])
-        self.patch_embed2 = PatchEmbedding(name='patch_embed2', img_size=img_size // 4, patch_size=2, embedding_dim=embed_dims[1])
-        self.patch_embed3 = PatchEmbedding(name='patch_embed3', img_size=img_size // 8, patch_size=2, embedding_dim=embed_dims[2])
+        # patch_embed, stage 1 to 3 add their own position embedding
+        self.patch_embed1 = PatchEmbedding(name='patch_embed1', img_size=img_size, patch_size=patch_size, embedding_dim=embed_dims[0], use_pos_embed=True)
+        self.patch_embed2 = PatchEmbedding(name='patch_embed2', img_size=img_size // 4, patch_size=2, embedding_dim=embed_dims[1], use_pos_embed=True)
+        self.patch_embed3 = PatchEmbedding(name='patch_embed3', img_size=img_size // 8, patch_size=2, embedding_dim=embed_dims[2], use_pos_embed=True)
         self.patch_embed4 = PatchEmbedding(name='patch_embed4', img_size=img_size // 16, patch_size=2, embedding_dim=embed_dims[3])
 
-        # position embedding
+        # position embedding of stage 4, it also covers the cls token so it is added after the concat
         self.weight_initializer = tf.keras.initializers.TruncatedNormal(mean=0., stddev=.02)
-        self.pos_embed1 = None
-        self.pos_embed2 = None
-        self.pos_embed3 = None
         self.pos_embed4 = None
-        self.pos_drop1 = layers.Dropout(drop_rate)
-        self.pos_drop2 = layers.Dropout(drop_rate)
-        self.pos_drop3 = layers.Dropout(drop_rate)
-        self.pos_drop4 = layers.Dropout(drop_rate)
+        self.pos_drop1 = layers.Dropout(drop_rate) if drop_rate > 0 else None
+        self.pos_drop2 = layers.Dropout(drop_rate) if drop_rate > 0 else None
+        self.pos_drop3 = layers.Dropout(drop_rate) if drop_rate > 0 else None
+        self.pos_drop4 = layers.Dropout(drop_rate) if drop_rate > 0 else None
 
-        # Blocks
-        self.block1 = [Block(name=f'BLOCK1_{i}', dim=embed_dims[0], num_heads=num_heads[0], mlp_ratio=mlp_ratios[0], qkv_bias=qkv_bias, qk_scale=qk_scale,
-            drop=drop_rate, attn_drop=attn_drop_rate, sr_ratio=sr_ratios[0]) for i in range(depths[0])]
+        # transformer encoder of each stage, stage 4 is not merged since it carries the cls token
+        self.stage1 = Stage(name='BLOCK1', depth=depths[0], dim=embed_dims[0], num_heads=num_heads[0], mlp_ratio=mlp_ratios[0], qkv_bias=qkv_bias, qk_scale=qk_scale,
+            drop=drop_rate, attn_drop=attn_drop_rate, sr_ratio=sr_ratios[0],
+            grid_size=(self.patch_embed1.H, self.patch_embed1.W), merge_every=merge_every)
 
-        self.block2 = [Block(name=f'BLOCK2_{i}', dim=embed_dims[1], num_heads=num_heads[1], mlp_ratio=mlp_ratios[1], qkv_bias=qkv_bias, qk_scale=qk_scale,
-            drop=drop_rate, attn_drop=attn_drop_rate, sr_ratio=sr_ratios[1]) for i in range(depths[1])]
+        self.stage2 = Stage(name='BLOCK2', depth=depths[1], dim=embed_dims[1], num_heads=num_heads[1], mlp_ratio=mlp_ratios[1], qkv_bias=qkv_bias, qk_scale=qk_scale,
+            drop=drop_rate, attn_drop=attn_drop_rate, sr_ratio=sr_ratios[1],
+            grid_size=(self.patch_embed2.H, self.patch_embed2.W), merge_every=merge_every)
 
-        self.block3 = [Block(name=f'BLOCK3_{i}', dim=embed_dims[2], num_heads=num_heads[2], mlp_ratio=mlp_ratios[2], qkv_bias=qkv_bias, qk_scale=qk_scale,
-            drop=drop_rate, attn_drop=attn_drop_rate, sr_ratio=sr_ratios[2]) for i in range(depths[2])]
+        self.stage3 = Stage(name='BLOCK3', depth=depths[2], dim=embed_dims[2], num_heads=num_heads[2], mlp_ratio=mlp_ratios[2], qkv_bias=qkv_bias, qk_scale=qk_scale,
+            drop=drop_rate, attn_drop=attn_drop_rate, sr_ratio=sr_ratios[2],
+            grid_size=(self.patch_embed3.H, self.patch_embed3.W), merge_every=merge_every)
 
-        self.block4 = [Block(name=f'BLOCK4_{i}', dim=embed_dims[3], num_heads=num_heads[3], mlp_ratio=mlp_ratios[3], qkv_bias=qkv_bias, qk_scale=qk_scale,
-            drop=drop_rate, attn_drop=attn_drop_rate, sr_ratio=sr_ratios[3]) for i in range(depths[3])]
+        self.stage4 = Stage(name='BLOCK4', depth=depths[3], dim=embed_dims[3], num_heads=num_heads[3], mlp_ratio=mlp_ratios[3], qkv_bias=qkv_bias, qk_scale=qk_scale,
+            drop=drop_rate, attn_drop=attn_drop_rate, sr_ratio=sr_ratios[3],
+            grid_size=(self.patch_embed4.H, self.patch_embed4.W))
 
         self.norm = layers.LayerNormalization()
 
         # class token
         self.cls_token = None
 
-        # dense layer for prediction
-        self.dense = layers.Dense(num_classes, name='CLASSIFICATION_DENSE')
+        # dense layer for prediction, float32 logits
+        self.dense = layers.Dense(num_classes, dtype='float32', name='CLASSIFICATION_DENSE')
 
 
     def get_config(self):
@@ -232,9 +365,6 @@ class PyramidVisionTransformer(Model):
 
 
     def build(self, input_shape):
-        self.pos_embed1 = self.add_weight(shape=[1, self.patch_embed1.num_patches, self.embed_dims[0]], initializer=self.weight_initializer, name='pos_embed1')
-        self.pos_embed2 = self.add_weight(shape=[1, self.patch_embed2.num_patches, self.embed_dims[1]], initializer=self.weight_initializer, name='pos_embed2')
-        self.pos_embed3 = self.add_weight(shape=[1, self.patch_embed3.num_patches, self.embed_dims[2]], initializer=self.weight_initializer, name='pos_embed3')
         self.pos_embed4 = self.add_weight(shape=[1, self.patch_embed4.num_patches + 1, self.embed_dims[3]], initializer=self.weight_initializer, name='pos_embed4')
         self.cls_token = self.add_weight(shape=[1, 1, self.embed_dims[3]], initializer=self.weight_initializer, name='cls_token')
         super(PyramidVisionTransformer, self).build(input_shape)
@@ -244,40 +374,34 @@ class PyramidVisionTransformer(Model):
     def call(self, inputs):
 
         # stage 1, patch image (b, 224, 224, 3) -> (b, 56, 56, 64) -> (b, 3136, 64)
-        x, (H, W) = self.patch_embed1(inputs)
-        # adding position embedding
-        x = x + self.pos_embed1
+        x, (H, W) = self.patch_embed1(inputs) # with position embedding
         # dropout
-        x = self.pos_drop1(x)
+        if self.pos_drop1 is not None:
+            x = self.pos_drop1(x)
         # transformer encoder
-        for blk in self.block1:
-            x = blk(x, H, W) # (b, 3136, 64)
+        x = self.stage1(x, H, W) # (b, 3136, 64)
 
         # (b, 3136, 64) -> (b, 56, 56, 64)
         x = tf.reshape(x, [-1, H, W, self.embed_dims[0]])
 
         # stage 2 patch image (b, 56, 56, 64) -> (b, 28, 28, 64) -> (b, 784, 128)
-        x, (H, W) = self.patch_embed2(x)
-        # adding position embedding
-        x = x + self.pos_embed2
+        x, (H, W) = self.patch_embed2(x) # with position embedding
         # dropout
-        x = self.pos_drop2(x)
+        if self.pos_drop2 is not None:
+            x = self.pos_drop2(x)
         # transformer encoder
-        for blk in self.block2:
-            x = blk(x, H, W) # (b, 784, 128)
+        x = self.stage2(x, H, W) # (b, 784, 128)
 
         # (b, 784, 128) -> (b, 28, 28, 128)
         x = tf.reshape(x, [-1, H, W, self.embed_dims[1]])
 
         # stage 3 patch image (b, 28, 28, 128) -> (b, 14, 14, 256) -> (b, 196, 256)
-        x, (H, W) = self.patch_embed3(x)
-        # adding position embedding
-        x = x + self.pos_embed3
+        x, (H, W) = self.patch_embed3(x) # with position embedding
         # dropout
-        x = self.pos_drop3(x)
+        if self.pos_drop3 is not None:
+            x = self.pos_drop3(x)
         # transformer encoder
-        for blk in self.block3:
-            x = blk(x, H, W) # (b, 196, 256)
+        x = self.stage3(x, H, W) # (b, 196, 256)
 
         # (b, 196, 256) -> (b, 14, 14, 256)
         x = tf.reshape(x, [-1, H, W, self.embed_dims[2]])
@@ -285,15 +409,17 @@ class PyramidVisionTransformer(Model):
         # stage 4 patch image (b, 14, 14, 256) -> (b, 7, 7, 512) -> (b, 49, 512)
         x, (H, W) = self.patch_embed4(x)
         # concat with cls token (b, 49, 512) -> (b, 50, 512)
-        cls_token = tf.broadcast_to(self.cls_token, [self.batch_size, 1, self.embed_dims[3]])
-        x = layers.concatenate([cls_token, x], axis=1)
+        # broadcast to the runtime batch size so a traced graph is not tied to a fixed batch
+        cls_token = tf.broadcast_to(self.cls_token, [tf.shape(x)[0], 1, self.embed_dims[3]])
+        cls_token = tf.cast(cls_token, dtype=x.dtype)
+        x = tf.concat([cls_token, x], axis=1)
         # adding position embedding
-        x = x + self.pos_embed4
+        x = x + tf.cast(self.pos_embed4, dtype=x.dtype)
         # dropout
-        x = self.pos_drop4(x)
+        if self.pos_drop4 is not None:
+            x = self.pos_drop4(x)
         # transformer encoder
-        for blk in self.block4:
-            x = blk(x, H, W) # (b, 50, 512)
+        x = self.stage4(x, H, W) # (b, 50, 512)
 
         # layer normalization
         x = self.norm(x)
@@ -373,6 +499,17 @@ if __name__ == '__main__':
 
     pvt = pvt_tiny(batch_size=4, img_size=32, num_classes=10)
 
-    outputs = pvt(inputs)
+    infer = tf.function(pvt, input_signature=[tf.TensorSpec([4, 32, 32, 3], tf.float32)])
+
+    outputs = infer(inputs)
 
     print(outputs.shape)
+
+    # token merging, stage 3 of pvt_small on a 14x14 grid: 14x14 -> 14x7 -> 7x7 and stop at the odd width
+    assert Stage.plan_merges((3, 4, 18, 3)[2], (14, 14), 1) == [None, 'w', 'h'] + [None] * 15
+
+    pvt_merged = pvt_tiny(batch_size=4, img_size=32, num_classes=10, merge_every=1)
+
+    outputs = tf.function(pvt_merged, input_signature=[tf.TensorSpec([4, 32, 32, 3], tf.float32)])(inputs)
+
+    assert outputs.shape == (4, 10), outputs.shape
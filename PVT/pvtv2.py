@@ -2,11 +2,13 @@ import os
 import tensorflow as tf
 import tensorflow_addons as tfa
 from tensorflow.keras import layers, Model
+from common.initializers import DenseGlorotUniform
 
 os.environ['CPP_TF_MIN_LOG_LEVEL'] = '2'
 
 print(tf.__version__)
 
+
 class MLP(layers.Layer):
     """
     MLP layer in PVT-v2 mainly added Depth Wise Conv layers after 1st FC layer
@@ -17,10 +19,10 @@ class MLP(layers.Layer):
         self.hidden_features = hidden_features
         self.fc1 = layers.Dense(hidden_features, name=f'{name}_MLP_DENSE1')
         self.DConv = layers.DepthwiseConv2D(3, strides=(1, 1), padding='same')
-        self.act = tfa.layers.GELU()
+        self.act = layers.Lambda(lambda x: tf.nn.gelu(x, approximate=True))
         self.fc2 = layers.Dense(out_features, name=f'{name}_MLP_DENSE2')
-        self.drop1 = layers.Dropout(drop_rate, name=f'{name}_MLP_DROP1')
-        self.drop2 = layers.Dropout(drop_rate, name=f'{name}_MLP_DROP2')
+        self.drop1 = layers.Dropout(drop_rate, name=f'{name}_MLP_DROP1') if drop_rate > 0 else None
+        self.drop2 = layers.Dropout(drop_rate, name=f'{name}_MLP_DROP2') if drop_rate > 0 else None
 
 
     def call(self, inputs, H, W, training=None):
@@ -34,10 +36,10 @@ class MLP(layers.Layer):
         # [B, H, W, hidden_features] -> [B, N, hidden_features]
         x = tf.reshape(x, [-1, H*W, self.hidden_features])
         x = self.act(x)
-        if training:
+        if self.drop1 is not None:
             x = self.drop1(x)
         x = self.fc2(x)
-        if training:
+        if self.drop2 is not None:
             x = self.drop2(x)
 
         return x
@@ -58,90 +60,92 @@ class Attention(layers.Layer):
         self.scale = qk_scale or self.head_dim ** -.5
         self.linear = linear
 
-        self.q = layers.Dense(dim, use_bias=qkv_bias, name=f'{name}_Q')
-        self.kv = layers.Dense(2 * dim, use_bias=qkv_bias, name=f'{name}_KV')
-        self.attention_drop = layers.Dropout(attn_drop, name=f'{name}_ATTEN_DROP')
-        self.proj = layers.Dense(dim, name=f'{name}_PROJ_DENSE')
-        self.proj_drop = layers.Dropout(proj_drop, name=f'{name}_PROJ_DROP')
-
         self.sr_ratio = sr_ratio
+        # q and kv read the same input when there is no spatial reduction, so project them with a single GEMM
+        self.fused_qkv = not linear and sr_ratio == 1
+        # projections write straight into the head layout, no reshape or transpose needed afterwards
+        if self.fused_qkv:
+            # (b, N, C) -> (b, 3, num_heads, N, head_dim)
+            self.qkv = layers.EinsumDense('bnc,cihd->bihnd', output_shape=(3, num_heads, None, self.head_dim),
+                                          bias_axes='ihd' if qkv_bias else None, name=f'{name}_QKV',
+                                          # q slice scaled like the old Dense(dim), k and v slices like the old Dense(2 * dim)
+                                          kernel_initializer=DenseGlorotUniform(fan_outs=[dim, 2 * dim, 2 * dim]))
+        else:
+            # (b, N, C) -> (b, num_heads, N, head_dim)
+            self.q = layers.EinsumDense('bnc,chd->bhnd', output_shape=(num_heads, None, self.head_dim),
+                                        bias_axes='hd' if qkv_bias else None, kernel_initializer=DenseGlorotUniform(), name=f'{name}_Q')
+            # (b, N', C) -> (b, 2, num_heads, N', head_dim)
+            self.kv = layers.EinsumDense('bnc,cihd->bihnd', output_shape=(2, num_heads, None, self.head_dim),
+                                         bias_axes='ihd' if qkv_bias else None, kernel_initializer=DenseGlorotUniform(), name=f'{name}_KV')
+        self.attention_drop = layers.Dropout(attn_drop, name=f'{name}_ATTEN_DROP') if attn_drop > 0 else None
+        # (b, num_heads, N, head_dim) -> (b, N, C)
+        self.proj = layers.EinsumDense('bhnd,hdc->bnc', output_shape=(None, dim), bias_axes='c',
+                                       kernel_initializer=DenseGlorotUniform(fan_in_dims=2), name=f'{name}_PROJ_DENSE')
+        self.proj_drop = layers.Dropout(proj_drop, name=f'{name}_PROJ_DROP') if proj_drop > 0 else None
+
         if not linear:
             if sr_ratio > 1:
-                self.sr = layers.Conv2D(dim, kernel_size=sr_ratio, strides=sr_ratio, name=f'{name}_SR_CONV2D')
+                # non-overlapping sr_ratio x sr_ratio conv, expressed as one GEMM over each sr_ratio x sr_ratio block of tokens
+                # (b, H/sr, sr, W/sr, sr, C) -> (b, H/sr, W/sr, C)
+                self.sr = layers.EinsumDense('bhpwqc,pqcd->bhwd', output_shape=(None, None, dim), bias_axes='d', name=f'{name}_SR')
                 self.norm = layers.LayerNormalization()
         else:
             self.pool = tfa.layers.AdaptiveAveragePooling2D(2) # in paper use 7, but since we are testing on small image, we use 2 here
             self.sr = layers.Conv2D(dim, kernel_size=1, strides=1)
             self.norm = layers.LayerNormalization()
-            self.act = tfa.layers.GELU()
+            self.act = layers.Lambda(lambda x: tf.nn.gelu(x, approximate=True))
 
 
     def call(self, inputs, H, W):
-        # (b, 196, 768) -> (b, 196, num_heads, head_dim)
-        q = layers.Reshape((-1, self.num_heads, self.head_dim))(self.q(inputs))
-        # (b, 196, num_heads, head_dim)-> (b, num_heads, 196, head_dim)
-        q = tf.transpose(q, [0, 2, 1, 3])
-
-        if not self.linear:
-            if self.sr_ratio > 1:
-                # (b, 196, 768) -> (b, 14, 14, 768)
-                x_ = tf.reshape(inputs, [-1, H, W, self.dim])
-                # (b, 14, 14, 768) -> (b, 7, 7, 768)
+        if self.fused_qkv:
+            # (b, 196, 768) -> (b, 3, num_heads, 196, head_dim)
+            qkv = self.qkv(inputs)
+            q, k, v = qkv[:, 0], qkv[:, 1], qkv[:, 2]
+        else:
+            # (b, 196, 768) -> (b, num_heads, 196, head_dim)
+            q = self.q(inputs)
+            if not self.linear:
+                # (b, 196, 768) -> (b, 7, 2, 7, 2, 768)
+                x_ = tf.reshape(inputs, [-1, H//self.sr_ratio, self.sr_ratio, W//self.sr_ratio, self.sr_ratio, self.dim])
+                # (b, 7, 2, 7, 2, 768) -> (b, 7, 7, 768)
                 x_ = self.sr(x_)
                 # (b, 7, 7, 768) -> (b, 49, 768)
                 x_ = tf.reshape(x_, [-1, H//self.sr_ratio * W//self.sr_ratio, self.dim])
                 # (b, 49, 768)
                 x_ = self.norm(x_)
-                # (b, 49, 768) -> # (b, 49, 768 *2)
+                # (b, 49, 768) -> (b, 2, num_heads, 49, head_dim)
                 kv = self.kv(x_)
-                # (b, 49, 768 *2) -> (b, 49, 2, num_heads, head_dim)
-                kv = tf.reshape(kv, [-1, H//self.sr_ratio * W//self.sr_ratio, 2, self.num_heads, self.head_dim])
-                # (b, 49, 2, num_heads, head_dim) -> (2, b, num_heads, 49, head_dim)
-                kv = tf.transpose(kv, [2, 0, 3, 1, 4])
             else:
-                # (b, 196, 768) -> # (b, 49, 768 *2)
-                kv = self.kv(inputs)
-                # (b, 196, 768 *2) -> (b, 196, 2, num_heads, head_dim)
-                kv = layers.Reshape((-1, 2, self.num_heads, self.head_dim))(kv)
-                # (b, 49, 2, num_heads, head_dim) -> (2, b, num_heads, 49, head_dim)
-                kv = tf.transpose(kv, [2, 0, 3, 1, 4])
-        else:
-            # (b, 196, 768) -> (b, 14, 14, 768)
-            x_ = tf.reshape(inputs, [-1, H, W, self.dim])
-            # (b, 14, 14, 768) -> (b, 2, 2, 768)
-            x_ = self.pool(x_)
-            # (b, 2, 2, 768) -> (b, 2, 2, 768)
-            x_ = self.sr(x_)
-            # (b, 2, 2, 768) -> (b, 4, 768)
-            x_ = tf.reshape(x_, [-1, 4, self.dim])
-            # (b, 4, 768)
-            x_ = self.norm(x_)
-            # (b, 4, 768)
-            x_ = self.act(x_)
-            # (b, 4, 768) -> # (b, 4, 768 *2)
-            kv = self.kv(x_)
-            # (b, 4, 768 *2) -> (b, 4, 2, num_heads, head_dim)
-            kv = tf.reshape(kv, [-1, 4, 2, self.num_heads, self.head_dim])
-            # (b, 4, 2, num_heads, head_dim) -> (2, b, num_heads, 4, head_dim)
-            kv = tf.transpose(kv, [2, 0, 3, 1, 4])
-
-        # retrieve k,v
-        k, v = kv[0], kv[1]
+                # (b, 196, 768) -> (b, 14, 14, 768)
+                x_ = tf.reshape(inputs, [-1, H, W, self.dim])
+                # (b, 14, 14, 768) -> (b, 2, 2, 768)
+                x_ = self.pool(x_)
+                # (b, 2, 2, 768) -> (b, 2, 2, 768)
+                x_ = self.sr(x_)
+                # (b, 2, 2, 768) -> (b, 4, 768)
+                x_ = tf.reshape(x_, [-1, 4, self.dim])
+                # (b, 4, 768)
+                x_ = self.norm(x_)
+                # (b, 4, 768)
+                x_ = self.act(x_)
+                # (b, 4, 768) -> (b, 2, num_heads, 4, head_dim)
+                kv = self.kv(x_)
+            # retrieve k,v
+            k, v = kv[:, 0], kv[:, 1]
+
         # calc attention
         # (b, num_heads, 196, 96) * (b, num_heads, 96, 196) ->  (b, num_heads, 196, 196)
-        attention = tf.matmul(q, tf.transpose(k, [0,1,3,2])) * self.scale
+        attention = tf.matmul(q, k, transpose_b=True) * self.scale
         # (b, num_heads, 196, 196)
         attention = tf.nn.softmax(attention, axis=-1)
-        attention = self.attention_drop(attention)
+        if self.attention_drop is not None:
+            attention = self.attention_drop(attention)
         # (b, num_heads, 196, 196) * (b, num_heads, 196, 96) -> (b, num_heads, 196, 96)
         x = tf.matmul(attention, v)
-        # (b, num_heads, 196, 96) -> (b, 196, num_heads, 96)
-        x = tf.transpose(x, [0, 2, 1, 3])
-        # (b, 196, num_heads, 96) -> (b, 196, num_heads * 96)
-        x = layers.Reshape((-1, self.num_heads * self.head_dim))(x)
-        # (b, N, C) -> (b, N, proj_dim)
+        # (b, num_heads, 196, 96) -> (b, 196, num_heads * 96)
         x = self.proj(x)
-        x = self.proj_drop(x)
+        if self.proj_drop is not None:
+            x = self.proj_drop(x)
 
         return x
 
@@ -251,8 +255,8 @@ class PyramidVisionTransformerV2(Model):
             setattr(self, f"block{i + 1}", block)
             setattr(self, f"norm{i + 1}", norm)
 
-        # classification head
-        self.head = layers.Dense(num_classes)
+        # classification head, float32 logits
+        self.head = layers.Dense(num_classes, dtype='float32')
 
 
 
@@ -351,7 +355,8 @@ if __name__ == '__main__':
     # test forward
     inputs = tf.random.normal([4, 32, 32, 3])
     pvtV2 = PyramidVisionTransformerV2(img_size=32, num_classes=100, linear=True)
-    outputs = pvtV2(inputs)
+    infer = tf.function(pvtV2, input_signature=[tf.TensorSpec([4, 32, 32, 3], tf.float32)])
+    outputs = infer(inputs)
     print(outputs.shape)
 
 
@@ -2,14 +2,18 @@ import os
 import tensorflow as tf
 from PVT.pvtv1 import pvt_tiny
 from PVT.pvtv2 import pvt_v2_b0, pvt_v2_b2_li
+from common.mixed_precision import set_mixed_precision_policy
 
 os.environ['CPP_TF_MIN_LOG_LEVEL'] = '2'
 
+
 # init hyper parameter
 batch_size = 64
 AUTO_TUNE = tf.data.AUTOTUNE
 lr = 1e-5
 
+set_mixed_precision_policy()
+
 """
 Here for simple, we use CIFAR100 image for test only
 You can use your own dataset as well but remember to update image size and patch size accordingly
@@ -39,10 +43,10 @@ def load_data(is_test):
 
     # create datasets
     ds_train = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    ds_train = ds_train.cache().map(preprocess).shuffle(50000).batch(batch_size, drop_remainder=True).prefetch(buffer_size=AUTO_TUNE)
+    ds_train = ds_train.map(preprocess, num_parallel_calls=AUTO_TUNE).cache().shuffle(50000).batch(batch_size, drop_remainder=True).prefetch(buffer_size=AUTO_TUNE)
 
     ds_test = tf.data.Dataset.from_tensor_slices((x_test, y_test))
-    ds_test = ds_test.cache().batch(batch_size, drop_remainder=True).map(preprocess)
+    ds_test = ds_test.map(preprocess, num_parallel_calls=AUTO_TUNE).batch(batch_size, drop_remainder=True).cache().prefetch(buffer_size=AUTO_TUNE)
 
     return ds_train, ds_test
 
@@ -55,7 +59,8 @@ def train(name, model, epochs, is_test=False):
 
     model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=lr),
                   loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-                  metrics=['accuracy'])
+                  metrics=['accuracy'],
+                  jit_compile=True)
 
     model.fit(ds_train, validation_data=ds_test, callbacks=[earlyStopCallBack], epochs=epochs)
 
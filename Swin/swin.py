@@ -1,6 +1,5 @@
 import os
 import tensorflow as tf
-import tensorflow_addons as tfa
 from tensorflow.keras import layers, Model
 
 os.environ['CPP_TF_MIN_LOG_LEVEL'] = '2'
@@ -12,7 +11,7 @@ class MLP(layers.Layer):
     """
     def __init__(self, hidden_features=None, out_features=None, drop=0.):
         self.fc1 = layers.Dense(hidden_features)
-        self.act = tfa.layers.GELU()
+        self.act = layers.Lambda(lambda x: tf.nn.gelu(x, approximate=True))
         self.fc2 = layers.Dense(out_features)
         self.drop = layers.Dropout(drop)
 
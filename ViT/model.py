@@ -1,8 +1,8 @@
 import os
 import tensorflow as tf
-import tensorflow_addons as tfa
 from tensorflow import keras
 from tensorflow.keras import layers, Model, Sequential
+from common.initializers import DenseGlorotUniform
 
 
 os.environ['CPP_TF_MIN_LOG_LEVEL'] = '2'
@@ -41,7 +41,7 @@ class ClassToken(layers.Layer):
 
 
     def call(self, inputs, training=None):
-        cls_broadcast = tf.broadcast_to(self.cls_w, [self.batch_size, 1, self.num_features])
+        cls_broadcast = tf.broadcast_to(self.cls_w, [tf.shape(inputs)[0], 1, self.num_features])
         cls_broadcast = tf.cast(cls_broadcast, dtype=inputs.dtype)
         return tf.concat([cls_broadcast, inputs], axis=1)
 
@@ -84,9 +84,14 @@ class MultiHeadSelfAttention(layers.Layer):
         self.num_features = num_features
         self.num_heads = num_heads
         self.project_dim = num_features // num_heads
-        self.qkv = layers.Dense(3 * self.num_features)
-        self.dense = layers.Dense(self.num_features)
-        self.dropout = layers.Dropout(dropout)
+        self.scale = self.project_dim ** -.5
+        # (batch_size, sequence_length, num_features) -> (batch_size, 3, num_heads, sequence_length, project_dim)
+        self.qkv = layers.EinsumDense('bnc,cihd->bihnd', output_shape=(3, num_heads, None, self.project_dim), bias_axes='ihd',
+                                      kernel_initializer=DenseGlorotUniform())
+        # (batch_size, num_heads, sequence_length, project_dim) -> (batch_size, sequence_length, num_features)
+        self.dense = layers.EinsumDense('bhnd,hdc->bnc', output_shape=(None, self.num_features), bias_axes='c',
+                                        kernel_initializer=DenseGlorotUniform(fan_in_dims=2))
+        self.dropout = layers.Dropout(dropout) if dropout > 0 else None
 
 
     def call(self, inputs, training=None):
@@ -94,30 +99,21 @@ class MultiHeadSelfAttention(layers.Layer):
         :param inputs: input feature map with shape (batch_size, sequence_length, 3 * num_features)
         :return: processed inputs
         """
-        batch_size = inputs.shape[0]
-        # (batch_size, sequence_length, num_features) => (batch_size, sequence_length, 3 * num_features)
+        # (batch_size, sequence_length, num_features) => (batch_size, 3, num_heads, sequence_length, project_dim)
         qkv = self.qkv(inputs)
-        # (batch_size, sequence_length, 3 * num_features) -> (batch_size, sequence_length, 3, num_heads, project_dim)
-        inputs = tf.reshape(qkv, [batch_size, -1, 3, self.num_heads, self.project_dim])
-        # (batch_size, sequence_length, 3, num_heads, project_dim) -> (3, batch_size, num_heads, sequence_length, project_dim)
-        inputs = tf.transpose(inputs, [2, 0, 3, 1, 4])
         # retrieve q,k,v -> shape (batch_size, num_heads, sequence_length, project_dim)
-        query, key, value = inputs[0], inputs[1], inputs[2]
+        query, key, value = qkv[:, 0], qkv[:, 1], qkv[:, 2]
         # calculate score if sequence_length = 197 and project_dim = 64 (b, num_heads, 197, 64) @ (b, num_heads, 197, 64).T -> (b, num_heads, 197, 197)
         score = tf.matmul(query, key, transpose_b=True)
         # calculate scaled score
-        scaled_score = score / tf.sqrt(tf.cast(self.project_dim, dtype=score.dtype))
+        scaled_score = score * self.scale
         # calculate weights (b, num_heads, 197, 197)
         weights = tf.nn.softmax(scaled_score, axis=-1)
         # calculate weighted value (b, num_heads, 197, 197) @ (b, num_heads, 197, 64) -> (b, num_heads, 197, 64)
         weighted_value = tf.matmul(weights, value)
-        # (b, num_heads, 197, 64) -> (b, 197, num_heads, 64)
-        outputs = tf.transpose(weighted_value, [0, 2, 1, 3])
-        # (b, 197, num_heads, 64) -> (b, 197, num_heads*64)
-        outputs = tf.reshape(outputs, [batch_size, -1, self.num_features])
-        # (b, 197, num_heads*64) -> (b, 197, num_heads*64)
-        outputs = self.dense(outputs)
-        if training:
+        # (b, num_heads, 197, 64) -> (b, 197, num_heads*64)
+        outputs = self.dense(weighted_value)
+        if self.dropout is not None:
             outputs = self.dropout(outputs)
         return outputs
 
@@ -128,15 +124,15 @@ class TransformerBlock(layers.Layer):
         super(TransformerBlock, self).__init__()
         self.layerNorm1 = layers.LayerNormalization(epsilon=1e-6)
         self.multiHeadSelfAttention = MultiHeadSelfAttention(num_features, num_heads, dropout)
-        self.dropout1 = layers.Dropout(dropout)
+        self.dropout1 = layers.Dropout(dropout) if dropout > 0 else None
         self.layerNorm2 = layers.LayerNormalization(epsilon=1e-6)
         self.MLP = Sequential([
             layers.Dense(mlp_dim),
-            tfa.layers.GELU(),
-            layers.Dropout(dropout),
+            layers.Lambda(lambda x: tf.nn.gelu(x, approximate=True)),
+            *([layers.Dropout(dropout)] if dropout > 0 else []),
             layers.Dense(num_features)
         ])
-        self.dropout2 = layers.Dropout(dropout)
+        self.dropout2 = layers.Dropout(dropout) if dropout > 0 else None
 
 
     def call(self, inputs, training=None):
@@ -145,19 +141,19 @@ class TransformerBlock(layers.Layer):
         # multi-head attention
         x = self.multiHeadSelfAttention(x)
         # dropout 1
-        if training:
+        if self.dropout1 is not None:
             x = self.dropout1(x)
         # residual
-        x = layers.Add()([inputs, x])
+        x = inputs + x
         # layer normalization
         y = self.layerNorm2(x)
         # MLP
         y = self.MLP(y)
         # dropout 2
-        if training:
+        if self.dropout2 is not None:
             y = self.dropout2(y)
         # residual
-        y = layers.Add()([x, y])
+        y = x + y
 
         return y
 
@@ -186,7 +182,7 @@ class VisionTransformer(Model):
         self.num_classes = num_classes
         self.dropout = dropout
         self.conv = layers.Conv2D(num_features, kernel_size=patch_size, strides=patch_size)
-        self.reshape = layers.Reshape(((input_shape[0]//patch_size) * (input_shape[1]//patch_size), num_features))
+        self.num_patches = (input_shape[0]//patch_size) * (input_shape[1]//patch_size)
         self.classToken = ClassToken(batch_size)
         self.positionEmbedding = PositionEmbedding()
         self.transformerBlocks = Sequential([
@@ -194,13 +190,13 @@ class VisionTransformer(Model):
         ])
         self.layerNormalization = layers.LayerNormalization(epsilon=1e-6)
         self.extractClassToken = layers.Lambda(lambda x: x[:,0,:])
-        self.dense = layers.Dense(num_classes)
+        self.dense = layers.Dense(num_classes, dtype='float32')
 
     def call(self, inputs):
         # patching (b, 224, 224, 3) -> (b, 14, 14, 768)
         x = self.conv(inputs)
         # (b, 14, 14, 768) -> (b, 196, 768)
-        x = self.reshape(x)
+        x = tf.reshape(x, [-1, self.num_patches, self.num_features])
         # class token (b, 196, 768) -> (b, 197, 768)
         x = self.classToken(x)
         # position embedding (b, 197, 768)
@@ -1,6 +1,7 @@
 import os
 import tensorflow as tf
 from ViT.model import VisionTransformer
+from common.mixed_precision import set_mixed_precision_policy
 
 os.environ['CPP_TF_MIN_LOG_LEVEL'] = '2'
 
@@ -19,6 +20,8 @@ AUTO_TUNE = tf.data.AUTOTUNE
 lr = 1e-5
 checkpoint_filepath = './model/vit1.h5'
 
+set_mixed_precision_policy()
+
 # loading data
 (x_train, y_train), (x_test, y_test) = tf.keras.datasets.cifar100.load_data()
 assert x_train.shape == (50000, 32, 32, 3)
@@ -34,17 +37,18 @@ y_test = y_test[:1000]
 
 # create datasets
 ds_train = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-ds_train = ds_train.cache().map(preprocess).shuffle(50000).batch(batch_size, drop_remainder=True).prefetch(buffer_size=AUTO_TUNE)
+ds_train = ds_train.map(preprocess, num_parallel_calls=AUTO_TUNE).cache().shuffle(50000).batch(batch_size, drop_remainder=True).prefetch(buffer_size=AUTO_TUNE)
 
 ds_test = tf.data.Dataset.from_tensor_slices((x_test, y_test))
-ds_test = ds_test.cache().batch(batch_size, drop_remainder=True).map(preprocess)
+ds_test = ds_test.map(preprocess, num_parallel_calls=AUTO_TUNE).batch(batch_size, drop_remainder=True).cache().prefetch(buffer_size=AUTO_TUNE)
 
 # construct model
 ViT = VisionTransformer(batch_size=batch_size, input_shape=[32, 32], patch_size=4, num_layers=6, num_classes=100)
 
 ViT.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=lr),
             loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-            metrics=['accuracy'])
+            metrics=['accuracy'],
+            jit_compile=True)
 
 # callback for early stop
 earlyStopCallBack = tf.keras.callbacks.EarlyStopping(monitor='loss', patience=3)
@@ -63,7 +67,5 @@ ViT.fit(ds_train, validation_data=ds_test, callbacks=[earlyStopCallBack, modelCh
 
 # prediction
 test_data, test_label = next(iter(ds_test))
-# remember to pass batch size, default batch size is 32, if batch size is not matched, will encounter error when concat
-# cls token with inputs
 prediction = ViT.predict(test_data, batch_size=batch_size)
 
@@ -0,0 +1,34 @@
+import math
+import tensorflow as tf
+
+
+class DenseGlorotUniform(tf.keras.initializers.Initializer):
+    """
+    Glorot uniform initializer for EinsumDense kernels, with the fans of the Dense layer the kernel replaces
+    Keras' GlorotUniform treats any kernel with more than 2 dims as a conv kernel and scales it down
+    :param fan_in_dims: number of leading kernel dims contracted with the input, the rest are output dims
+    :param fan_outs: for a kernel packing several Dense layers along its first output dim, the fan_out of the Dense
+                     layer each slice replaces, so every slice keeps its own scale
+    """
+    def __init__(self, fan_in_dims=1, fan_outs=None):
+        self.fan_in_dims = fan_in_dims
+        self.fan_outs = fan_outs
+
+    def __call__(self, shape, dtype=None, **kwargs):
+        dims = [int(d) for d in shape]
+        dtype = dtype or tf.float32
+        fan_in = math.prod(dims[:self.fan_in_dims])
+        if self.fan_outs is None:
+            fan_out = math.prod(dims[self.fan_in_dims:])
+            limit = (6. / (fan_in + fan_out)) ** .5
+            return tf.random.uniform(dims, -limit, limit, dtype=dtype)
+        assert len(self.fan_outs) == dims[self.fan_in_dims], f"fan_outs {self.fan_outs} should have one entry per slice of kernel {dims}."
+        slice_shape = dims[:self.fan_in_dims] + [1] + dims[self.fan_in_dims + 1:]
+        slices = []
+        for fan_out in self.fan_outs:
+            limit = (6. / (fan_in + fan_out)) ** .5
+            slices.append(tf.random.uniform(slice_shape, -limit, limit, dtype=dtype))
+        return tf.concat(slices, axis=self.fan_in_dims)
+
+    def get_config(self):
+        return {'fan_in_dims': self.fan_in_dims, 'fan_outs': self.fan_outs}
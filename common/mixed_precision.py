@@ -0,0 +1,15 @@
+import tensorflow as tf
+
+
+def set_mixed_precision_policy():
+    """
+    set mixed_bfloat16 on GPUs with compute capability >= 8.0, mixed_float16 on >= 7.0, otherwise keep float32
+    """
+    gpus = tf.config.list_physical_devices('GPU')
+    if not gpus:
+        return
+    compute_capability = tf.config.experimental.get_device_details(gpus[0]).get('compute_capability', (0, 0))
+    if compute_capability >= (8, 0):
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    elif compute_capability >= (7, 0):
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')